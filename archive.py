@@ -1,16 +1,31 @@
+import concurrent.futures
+import csv
+import io
 import os
 import psycopg2
 import gspread
 import google.oauth2.service_account
-import json
+import orjson
+import random
 import sys
+import time
 from datetime import datetime, timezone
 
 # --- CONFIGURATION ---
-BATCH_SIZE = 5000
-ARCHIVE_OLDER_THAN_DAYS = 1 
+# Buffer this many rows locally before writing to Google Sheets. Each
+# append_rows call is a full Drive API round-trip, so we amortize the
+# writes into big batches.
+SHEETS_FLUSH = 10000
+# Commit the deletes every N flushed batches instead of every batch - each
+# commit is a WAL fsync on the server. If we crash in between, the next run
+# simply re-archives the un-deleted rows.
+COMMIT_EVERY = 10
+ARCHIVE_OLDER_THAN_DAYS = 1
 
 # --- LOAD SECRETS ---
+# TIP: Point DB_CONNECTION_STRING at Supabase's pooled endpoint (pgbouncer,
+# port 6543) so both connections this script opens skip most of the Postgres
+# auth/startup handshake.
 try:
     DB_URL = os.environ["DB_CONNECTION_STRING"]
     GDRIVE_KEY_JSON = os.environ["GDRIVE_SERVICE_ACCOUNT_KEY"]
@@ -20,10 +35,35 @@ except KeyError as e:
     print(f"---CRITICAL ERROR: Environment variable {e} not set.---", file=sys.stderr)
     sys.exit(1)
 
+def call_with_retry(fn, *args, max_tries=6, **kwargs):
+    """
+    Calls fn, retrying Drive/Sheets rate limits (429) and transient 5xx
+    errors with exponential backoff + jitter. Honors the Retry-After header
+    Google sends with quota errors so we sleep exactly as long as asked.
+    """
+    for attempt in range(max_tries):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if attempt == max_tries - 1:
+                raise
+            delay = 1.0 * (2 ** attempt)
+            response = getattr(e, 'response', None)
+            if response is not None:
+                retry_after = response.headers.get('Retry-After')
+                if retry_after:
+                    try:
+                        delay = max(delay, float(retry_after))
+                    except ValueError:
+                        pass
+            delay += random.uniform(0, 1.0)
+            print(f"Sheets API error ({e}). Retrying in {delay:.1f}s...", file=sys.stderr)
+            time.sleep(delay)
+
 def auth_google():
     """Authenticate with Google Sheets using the service account JSON."""
     try:
-        creds_json = json.loads(GDRIVE_KEY_JSON)
+        creds_json = orjson.loads(GDRIVE_KEY_JSON)
         scopes = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
         creds = google.oauth2.service_account.Credentials.from_service_account_info(creds_json, scopes=scopes)
         gc = gspread.authorize(creds)
@@ -70,81 +110,143 @@ def get_or_create_worksheet(sh, title, headers):
     return worksheet
 
 def archive_table(db_conn, gc, table_name, date_column, primary_key):
-    """Fetches, appends, and deletes data."""
+    """Streams old rows to Google Sheets, then deletes them."""
     print(f"\n--- Starting archive for table: {table_name} ---")
     total_archived = 0
-    
+
+    # COPY the qualifying rows out as CSV in one server-side operation. COPY
+    # skips the per-row protocol overhead of a normal SELECT, and the CSV text
+    # is exactly what Sheets needs - every cell arrives as a string, so the
+    # old per-cell str() pass disappears. We only hold one day's backlog
+    # (ARCHIVE_OLDER_THAN_DAYS), so buffering it in memory is fine.
+    # HEADER makes the first CSV row the column names, which replaces the old
+    # 'SELECT * LIMIT 0' probe (one round-trip saved per table).
+    print("Copying old rows out of the database...")
+    buf = io.StringIO()
     with db_conn.cursor() as cursor:
-        # Get column headers
-        cursor.execute(f"SELECT * FROM {table_name} LIMIT 0")
-        headers = [desc[0] for desc in cursor.description]
-        
-        try:
-            date_col_index = headers.index(date_column)
-        except ValueError:
-            print(f"Error: Date column '{date_column}' not found.")
-            return 0
-
-        while True:
-            print(f"Fetching batch of {BATCH_SIZE} old rows...")
-            cursor.execute(
-                f"""
+        cursor.copy_expert(
+            f"""
+            COPY (
                 SELECT * FROM {table_name}
                 WHERE {date_column} < (NOW() - INTERVAL '{ARCHIVE_OLDER_THAN_DAYS} days')
-                ORDER BY {date_column} ASC 
-                LIMIT {BATCH_SIZE}
-                """
+                ORDER BY {date_column} ASC
+            ) TO STDOUT WITH CSV HEADER
+            """,
+            buf
+        )
+    buf.seek(0)
+
+    reader = csv.reader(buf)
+    headers = next(reader, None)
+    if headers is None:
+        print("No more old rows found.")
+        return 0
+
+    try:
+        date_col_index = headers.index(date_column)
+        pk_index = headers.index(primary_key)
+    except ValueError:
+        print(f"Error: Date column '{date_column}' or primary key '{primary_key}' not found.")
+        return 0
+
+    # The deletes run on their own connection in a background thread, so the
+    # next Sheets append doesn't have to wait for the previous batch's DELETE
+    # round-trip to Supabase.
+    delete_conn = psycopg2.connect(DB_URL)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    delete_future = None
+    batches_since_commit = 0
+
+    def delete_batch(ids):
+        """Deletes one flushed batch (runs on the background thread)."""
+        nonlocal batches_since_commit
+        with delete_conn.cursor() as del_cursor:
+            del_cursor.execute(
+                # Pass the ids as a real array parameter instead of building a
+                # giant IN (...) literal (which also needed the one-element hack).
+                f"DELETE FROM {table_name} WHERE {primary_key} = ANY(%s)",
+                (ids,)
             )
-            rows = cursor.fetchall()
+        batches_since_commit += 1
+        if batches_since_commit >= COMMIT_EVERY:
+            delete_conn.commit()
+            batches_since_commit = 0
+        print(f"Deleted {len(ids)} rows from Supabase.")
 
-            if not rows:
-                print("No more old rows found.")
-                break
+    # Rows buffer here and flush to Sheets in bigger writes, since every
+    # append_rows call is a full Drive round-trip. A batch's rows are only
+    # handed to the deleter AFTER their Sheets write succeeds, same safety
+    # order as before.
+    pending_rows = []
+    pending_ids = []
+    pending_year = None
 
-            first_row_date = rows[0][date_col_index]
-            if isinstance(first_row_date, str):
-                data_year = first_row_date[:4]
-            else:
-                data_year = first_row_date.year
+    def flush_pending(year):
+        """Write the buffered rows to the workbook for `year`, then queue their delete."""
+        nonlocal delete_future
 
-            try:
-                sh = get_spreadsheet_for_year(gc, data_year)
-                worksheet = get_or_create_worksheet(sh, table_name, headers)
-            except Exception as e:
-                print(f"Skipping batch due to Google Sheet error: {e}")
-                break
+        sh = get_spreadsheet_for_year(gc, year)
+        worksheet = get_or_create_worksheet(sh, table_name, headers)
 
-            rows_to_append = []
-            ids_to_delete = []
-            
-            for row in rows:
-                row_date = row[date_col_index]
-                row_year = row_date.year if not isinstance(row_date, str) else int(row_date[:4])
-                
-                if row_year != int(data_year):
-                    break
-                    
-                rows_to_append.append([str(col) for col in row])
-                pk_index = headers.index(primary_key)
-                ids_to_delete.append(row[pk_index])
-
-            if rows_to_append:
-                print(f"Appending {len(rows_to_append)} rows to '{sh.title}'...")
+        print(f"Appending {len(pending_rows)} rows to '{sh.title}'...")
+        # 'RAW' skips the server-side cell parsing that USER_ENTERED does.
+        call_with_retry(worksheet.append_rows, pending_rows, value_input_option='RAW')
+
+        # Make sure the previous batch's delete finished before queueing this one.
+        if delete_future is not None:
+            delete_future.result()
+        delete_future = executor.submit(delete_batch, list(pending_ids))
+
+        flushed = len(pending_rows)
+        pending_rows.clear()
+        pending_ids.clear()
+        print(f"Flush complete. {flushed} rows archived.")
+        return flushed
+
+    try:
+        for row in reader:
+            # CSV gives us everything as text: "2025-11-03 14:30:00+00" etc.
+            row_year = int(row[date_col_index][:4])
+
+            # A year boundary forces a flush (each year has its own workbook).
+            if pending_year is not None and row_year != pending_year:
                 try:
-                    worksheet.append_rows(rows_to_append, value_input_option='USER_ENTERED')
+                    total_archived += flush_pending(pending_year)
                 except Exception as e:
-                    print(f"Failed to append to Google Sheet: {e}", file=sys.stderr)
-                    return 
-
-                print(f"Deleting {len(ids_to_delete)} rows from Supabase...")
-                ids_tuple = tuple(ids_to_delete)
-                if len(ids_tuple) == 1:
-                    ids_tuple = f"({ids_tuple[0]})"
-                    
-                cursor.execute(f"DELETE FROM {table_name} WHERE {primary_key} IN {ids_tuple}")
-                db_conn.commit()
-                total_archived += len(rows_to_append)
-                print(f"Batch complete. Total archived: {total_archived}")
+                    print(f"Stopping archive due to Google Sheet error: {e}", file=sys.stderr)
+                    return total_archived
+
+            pending_year = row_year
+            pending_rows.append(row)
+            # Both tables use an integer id; COPY hands it back as text.
+            pending_ids.append(int(row[pk_index]))
+
+            if len(pending_rows) >= SHEETS_FLUSH:
+                try:
+                    total_archived += flush_pending(pending_year)
+                except Exception as e:
+                    print(f"Stopping archive due to Google Sheet error: {e}", file=sys.stderr)
+                    return total_archived
+
+        if pending_rows:
+            try:
+                total_archived += flush_pending(pending_year)
+            except Exception as e:
+                print(f"Stopping archive due to Google Sheet error: {e}", file=sys.stderr)
+                return total_archived
+
+        print("No more old rows found.")
+    finally:
+        # Always drain the in-flight delete before leaving, even on errors.
+        if delete_future is not None:
+            try:
+                delete_future.result()
+            except Exception as e:
+                print(f"Background delete failed: {e}", file=sys.stderr)
+        executor.shutdown(wait=True)
+        # Flush any deletes still sitting in the open transaction.
+        delete_conn.commit()
+        delete_conn.close()
 
     return total_archived
 
@@ -1,131 +1,225 @@
+import concurrent.futures
+import csv
+import io
 import os
+import orjson
+import random
 import requests
 import psycopg2
+from psycopg2.extras import execute_values
 import sys
+import time
 from datetime import datetime, timezone
-import json # Make sure this is still here
-_debug_main_park_printed = False # This will help us print only once
+
+# ciso8601 is a specialized C parser for ISO-8601 timestamps, much faster
+# than the stdlib one. Fall back quietly if the wheel isn't available.
+try:
+    import ciso8601
+    parse_iso_datetime = ciso8601.parse_datetime
+except ImportError:
+    parse_iso_datetime = datetime.fromisoformat
 
 # --- 1. CONFIGURATION ---
+# TIP: Point DB_CONNECTION_STRING at Supabase's pooled endpoint (pgbouncer,
+# port 6543, transaction mode). Each cron run opens exactly one short-lived
+# connection, which is the case the pooler exists for - it skips most of the
+# Postgres auth/startup cost on every run.
 DB_URL = os.environ.get("DB_CONNECTION_STRING")
 API_ENDPOINT = "https://api.themeparks.wiki/v1/entity/waltdisneyworldresort/live"
 SCHEDULE_ENDPOINT = "https://api.themeparks.wiki/v1/entity/waltdisneyworldresort/schedule"
 
+# frozensets so the per-entity 'in' checks in the hot loop are O(1) hashed
+# lookups instead of scanning a list.
+MAIN_PARK_NAMES = frozenset({
+    "Magic Kingdom Park",
+    "Epcot",
+    "Disney's Hollywood Studios",
+    "Disney's Animal Kingdom Theme Park"
+})
+PARK_ENTITY_TYPES = frozenset({"THEME_PARK", "PARK"})
+
+# One Session for both endpoints: keep-alive means the second request skips
+# the TCP + TLS handshake entirely. The adapter retries dropped connections;
+# HTTP-status retries (429/5xx) stay in call_with_retry, which knows about
+# Retry-After.
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=requests.adapters.Retry(connect=3, read=2, backoff_factor=0.5)
+))
+# Be explicit about compression: JSON this repetitive squeezes ~8x, so the
+# download is a fraction of the bytes. requests decompresses transparently.
+SESSION.headers["Accept-Encoding"] = "gzip, deflate"
+
+# (connect, read) timeouts - requests defaults to waiting forever.
+REQUEST_TIMEOUT = (5, 30)
+
+# Where we remember the live endpoint's ETag/Last-Modified between runs.
+# If the API says 304 Not Modified (typical overnight, when nothing changes),
+# we skip the whole download + parse + DB write. GitHub's hosted runners
+# start fresh so they won't have this file, but anything running on a
+# persistent host (or a cached runner) gets the savings.
+ETAG_CACHE_FILE = "/tmp/wait_times_etag.json"
+
+# Schedule data (park hours, crowd forecast) changes a few times a day at
+# most, so a fresh-enough copy on disk saves the whole second API call.
+# Same caveat as the ETag cache: hosted runners start clean.
+SCHEDULE_CACHE_FILE = "/tmp/schedule_cache.json"
+SCHEDULE_CACHE_TTL = 3600 # seconds
+
+def _load_etag_cache():
+    """Reads the saved validators from the last 200 response, if any."""
+    try:
+        with open(ETAG_CACHE_FILE, 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def _save_etag_cache(response):
+    """Stores the validators from a fresh 200 response for the next run."""
+    validators = {}
+    if response.headers.get('ETag'):
+        validators['etag'] = response.headers['ETag']
+    if response.headers.get('Last-Modified'):
+        validators['last_modified'] = response.headers['Last-Modified']
+    if validators:
+        try:
+            with open(ETAG_CACHE_FILE, 'wb') as f:
+                f.write(orjson.dumps(validators))
+        except OSError:
+            pass # cache is best-effort only
+
+def call_with_retry(fn, *args, max_tries=6, **kwargs):
+    """
+    Calls fn, retrying transient HTTP failures (429s, 5xx, dropped
+    connections) with exponential backoff + jitter instead of failing the
+    whole run on the first hiccup. Honors the server's Retry-After header
+    when it sends one.
+    """
+    for attempt in range(max_tries):
+        try:
+            return fn(*args, **kwargs)
+        except requests.exceptions.RequestException as e:
+            if attempt == max_tries - 1:
+                raise
+            delay = 0.5 * (2 ** attempt)
+            response = getattr(e, 'response', None)
+            if response is not None:
+                retry_after = response.headers.get('Retry-After')
+                if retry_after:
+                    try:
+                        delay = max(delay, float(retry_after))
+                    except ValueError:
+                        pass
+            delay += random.uniform(0, 0.5)
+            print(f"Request failed ({e}). Retrying in {delay:.1f}s...", file=sys.stderr)
+            time.sleep(delay)
+
+def _read_body(response):
+    """
+    Joins the streamed chunks ourselves instead of touching .content -
+    that path concatenates into a fresh bytes object and runs charset
+    detection we don't need, since orjson wants raw bytes anyway.
+    """
+    return b"".join(response.iter_content(chunk_size=65536))
+
+def _get_json(url):
+    """One API GET, raising on HTTP errors so call_with_retry can catch them."""
+    with SESSION.get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        # orjson parses the raw bytes directly - a lot faster than
+        # response.json() on the full-resort payload.
+        return orjson.loads(_read_body(response))
+
+def _get_live_json():
+    """Conditional GET for the live endpoint: sends our saved validators and
+    exits cleanly on 304 (nothing changed since the last run)."""
+    cached = _load_etag_cache()
+    headers = {}
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    with SESSION.get(API_ENDPOINT, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        if response.status_code == 304:
+            print("Live data not modified since last run (304). Nothing to do.")
+            sys.exit(0)
+        response.raise_for_status()
+        body = _read_body(response)
+    _save_etag_cache(response)
+    return orjson.loads(body)
+
 def fetch_wait_times():
     """Fetches live wait time data from the API."""
     try:
         print("Fetching data from API...")
-        response = requests.get(API_ENDPOINT)
-        response.raise_for_status()
+        data = call_with_retry(_get_live_json)
         print("Data fetched successfully.")
-        return response.json()
+        return data
     except requests.exceptions.RequestException as e:
         print(f"Error fetching from API: {e}", file=sys.stderr)
         return None
 
 def fetch_schedule_data():
-    """Fetches schedule data (hours, forecast) from the schedule API."""
+    """Fetches schedule data (hours, forecast), using a short-lived disk cache."""
+    try:
+        if os.path.exists(SCHEDULE_CACHE_FILE) and time.time() - os.path.getmtime(SCHEDULE_CACHE_FILE) < SCHEDULE_CACHE_TTL:
+            print("Using cached schedule data (under an hour old).")
+            with open(SCHEDULE_CACHE_FILE, 'rb') as f:
+                return orjson.loads(f.read())
+    except (OSError, ValueError):
+        pass # unreadable/corrupt cache: just fetch fresh
+
     try:
         print("Fetching schedule data from API...")
-        response = requests.get(SCHEDULE_ENDPOINT)
-        response.raise_for_status()
+        data = call_with_retry(_get_json, SCHEDULE_ENDPOINT)
         print("Schedule data fetched successfully.")
-        return response.json()
+        try:
+            with open(SCHEDULE_CACHE_FILE, 'wb') as f:
+                f.write(orjson.dumps(data))
+        except OSError:
+            pass # cache is best-effort only
+        return data
     except requests.exceptions.RequestException as e:
         print(f"Error fetching schedule data: {e}", file=sys.stderr)
         return None
 
-def get_main_park_data(data):
-    """
-    Finds the 4 main theme parks and returns their full operating data.
-    Returns a list of dictionaries.
-    """
-    global _debug_main_park_printed # Use the global flag
-    
-    main_park_names = [
-        "Magic Kingdom Park",
-        "Epcot",
-        "Disney's Hollywood Studios",
-        "Disney's Animal Kingdom Theme Park"
-    ]
-    park_data_list = []
-    
-    if 'liveData' not in data:
-        print("No 'liveData' key in API response.")
-        return []
-
-    park_entity_types = ["THEME_PARK", "PARK"]
-
-    for entity in data['liveData']:
-        if entity.get('entityType') in park_entity_types and entity.get('name') in main_park_names:
-            
-            # --- NEW DEBUG LOGIC ---
-            if not _debug_main_park_printed:
-                print("\n\n--- DEBUG: FOUND A MAIN PARK ENTITY ---")
-                try:
-                    print(json.dumps(entity, indent=2))
-                except Exception as e:
-                    print(f"Error printing entity: {e}")
-                print("---------------------------------------\n\n")
-                _debug_main_park_printed = True
-            # --- END DEBUG LOGIC ---
-
-            name = entity['name']
-            status = entity.get('status', 'Unknown')
-            
-            # These are the field names we need to verify
-            forecast_status = entity.get('crowdLevel', 'Unknown') 
-            open_time = None
-            close_time = None
-
-            op_hours_list = entity.get('operatingHours', [])
-            for schedule in op_hours_list:
-                if schedule.get('type') == 'OPERATING':
-                    open_time = schedule.get('startTime')
-                    close_time = schedule.get('endTime')
-                    break
-            
-            park_data = {
-                "name": name,
-                "status": status,
-                "forecast_status": forecast_status,
-                "open_time": open_time,
-                "close_time": close_time
-            }
-            park_data_list.append(park_data)
-            
-            # This print is still useful
-            print(f"Status check: {name} is {status}. Open: {open_time} Close: {close_time}")
-    
-    return park_data_list
-
-def get_main_park_data(data):
+def classify_entities(data):
     """
-    Finds the 4 main theme parks IN THE LIVE DATA
-    and returns their current status for the "all parks closed" check.
+    Walks 'liveData' ONCE and sorts the entities into everything the rest of
+    the script needs: the park id -> name map, the 4 main parks' statuses
+    (for the "all parks closed" check), and the ride entities worth saving.
+    The old code walked the same list once per question.
     """
-    main_park_names = [
-        "Magic Kingdom Park",
-        "Epcot",
-        "Disney's Hollywood Studios",
-        "Disney's Animal Kingdom Theme Park"
-    ]
+    park_map = {}
     park_statuses = {}
-    
+    attractions = []
+    skipped = 0
+
     if 'liveData' not in data:
         print("No 'liveData' key in API response.")
-        return {}
-
-    park_entity_types = ["THEME_PARK", "PARK"]
+        return park_map, park_statuses, attractions, skipped
 
     for entity in data['liveData']:
-        if entity.get('entityType') in park_entity_types and entity.get('name') in main_park_names:
-            name = entity['name']
-            status = entity.get('status', 'Unknown')
-            park_statuses[name] = status
-            print(f"Status check: {name} is {status}")
-    
-    return park_statuses
+        # One bound-method lookup per entity instead of one per field
+        g = entity.get
+        if g('entityType') in PARK_ENTITY_TYPES:
+            name = g('name')
+            park_map[entity['id']] = name
+            if name in MAIN_PARK_NAMES:
+                status = g('status', 'Unknown')
+                park_statuses[name] = status
+                print(f"Status check: {name} is {status}")
+        elif g('parkId'):
+            attractions.append(entity)
+        # Entities with a null parkId (resort-wide stuff) get skipped
+        else:
+            skipped += 1
+
+    print(f"Classified liveData: {len(park_map)} parks, {len(attractions)} attractions, {skipped} entities with null parkId.")
+    return park_map, park_statuses, attractions, skipped
 
 def save_daily_park_data(schedule_data, conn):
     """
@@ -140,60 +234,55 @@ def save_daily_park_data(schedule_data, conn):
     schedule_list = schedule_data['schedule']
     print("Attempting to save daily park data from 'schedule' key...")
     saved_count = 0
-    
-    main_park_names = [
-        "Magic Kingdom Park",
-        "Epcot",
-        "Disney's Hollywood Studios",
-        "Disney's Animal Kingdom Theme Park"
-    ]
-    
+
+    # Collect the (at most 4) park rows first, then upsert them in one
+    # multi-row statement instead of one round-trip per park.
+    rows = []
+
+    # Iterate over the SCHEDULE list
+    for park_schedule in schedule_list:
+
+        park_name = park_schedule.get('name')
+
+        if park_name in MAIN_PARK_NAMES:
+
+            forecast_status = park_schedule.get('crowdLevel')
+            open_time = None
+            close_time = None
+
+            op_hours_list = park_schedule.get('operatingHours', [])
+            for schedule in op_hours_list:
+                if schedule.get('type') == 'OPERATING':
+                    open_time = schedule.get('startTime')
+                    close_time = schedule.get('endTime')
+                    break
+
+            if open_time:
+                data_date = parse_iso_datetime(open_time).date()
+            else:
+                data_date = datetime.now(timezone.utc).date()
+
+            print(f"Found schedule for {park_name}: Open: {open_time}, Close: {close_time}, Forecast: {forecast_status}")
+
+            rows.append((data_date, park_name, open_time, close_time, forecast_status))
+
     try:
         with conn.cursor() as cursor:
-            # Iterate over the SCHEDULE list
-            for park_schedule in schedule_list:
-                
-                park_name = park_schedule.get('name')
-                
-                if park_name in main_park_names:
-                    
-                    forecast_status = park_schedule.get('crowdLevel')
-                    open_time = None
-                    close_time = None
-
-                    op_hours_list = park_schedule.get('operatingHours', [])
-                    for schedule in op_hours_list:
-                        if schedule.get('type') == 'OPERATING':
-                            open_time = schedule.get('startTime')
-                            close_time = schedule.get('endTime')
-                            break 
-                    
-                    if open_time:
-                        data_date = datetime.fromisoformat(open_time).date()
-                    else:
-                        data_date = datetime.now(timezone.utc).date()
-
-                    print(f"Found schedule for {park_name}: Open: {open_time}, Close: {close_time}, Forecast: {forecast_status}")
-
-                    cursor.execute(
-                        """
-                        INSERT INTO park_operating_data 
-                            (data_date, park_name, open_time, close_time, forecast_status)
-                        VALUES 
-                            (%s, %s, %s, %s, %s)
-                        ON CONFLICT (park_name, data_date) DO NOTHING;
-                        """,
-                        (
-                            data_date,
-                            park_name,
-                            open_time,
-                            close_time,
-                            forecast_status
-                        )
-                    )
-                    saved_count += cursor.rowcount
-        
-        conn.commit()
+            if rows:
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO park_operating_data
+                        (data_date, park_name, open_time, close_time, forecast_status)
+                    VALUES %s
+                    ON CONFLICT (park_name, data_date) DO NOTHING;
+                    """,
+                    rows
+                )
+                saved_count = cursor.rowcount
+
+        # No commit here - main()'s 'with conn:' block commits both savers
+        # in ONE transaction (one round-trip, and the run is atomic).
         if saved_count > 0:
             print(f"Successfully saved new daily data for {saved_count} parks.")
         else:
@@ -203,66 +292,88 @@ def save_daily_park_data(schedule_data, conn):
         print(f"Error saving daily park data: {e}", file=sys.stderr)
         conn.rollback()
 
-# --- MODIFIED: Added 'run_time' as a new parameter ---
-# --- MODIFIED: Added 'run_time' as a new parameter ---
-def save_to_database(data, conn, run_time):
-    """Saves the relevant ride data from the 'liveData' list."""
-    rides_processed = 0
-    rides_skipped = 0 # <-- NEW: Counter for skipped records
-    
-    if 'liveData' not in data:
-        print("No 'liveData' key in API response.")
-        return
-
-    park_entity_types = ["THEME_PARK", "PARK"]
-    park_map = {}
-    for entity in data['liveData']:
-        if entity.get('entityType') in park_entity_types:
-            park_map[entity['id']] = entity.get('name')
-            
+def save_to_database(attractions, park_map, conn, run_time):
+    """Saves the ride entities that classify_entities picked out of 'liveData'."""
     if not park_map:
         print("Warning: park_map is EMPTY. No parks found in liveData.")
-    else:
-        print(f"Built park_map with {len(park_map)} parks from liveData.")
 
     try:
         with conn.cursor() as cursor:
-            for entity in data['liveData']:
-                    
-                    # --- NEW LOGIC: Check for parkId FIRST ---
-                    park_id = entity.get('parkId')
-                    
-                    # If park_id is valid (not None), process the ride.
-                    if park_id:
-                        park_name = park_map.get(park_id, "Unknown")
-                        ride_name = entity.get('name')
-                        status = entity.get('status')
-                        
-                        attraction_type = entity.get('entityType')
-                        
-                        wait_time = None
-                        if 'queue' in entity and 'STANDBY' in entity['queue']:
-                            wait_time = entity['queue']['STANDBY'].get('waitTime')
-                        
-                        # Only insert if it has a ride name
-                        if ride_name:
-                            cursor.execute(
-                                """
-                                INSERT INTO wait_times (timestamp, park_name, ride_name, wait_time_minutes, status, attraction_type)
-                                VALUES (%s, %s, %s, %s, %s, %s)
-                                """,
-                                (run_time, park_name, ride_name, wait_time, status, attraction_type)
-                            )
-                            rides_processed += 1
-                    
-                    # If park_id is None (null), skip this entity
-                    else:
-                        rides_skipped += 1
-                    # --- END OF NEW LOGIC ---
-        
-        conn.commit()
-        # --- MODIFIED: Updated print statement ---
-        print(f"Successfully saved data for {rides_processed} rides. Skipped {rides_skipped} attractions with null parkId. (Using script-generated timestamp)")
+            # Wait-time samples are lossy-tolerant telemetry: skip the WAL
+            # fsync on commit for this transaction only. Postgres flushes it
+            # in the background instead, so COMMIT returns immediately.
+            cursor.execute("SET LOCAL synchronous_commit = off")
+
+            # Grab the latest saved sample per ride so unchanged rides can be
+            # skipped this tick. Overnight / early morning almost nothing
+            # moves, which shrinks those batches to near zero rows.
+            cursor.execute(
+                """
+                SELECT DISTINCT ON (ride_name) ride_name, wait_time_minutes, status
+                FROM wait_times
+                ORDER BY ride_name, id DESC
+                """
+            )
+            last_seen = {name: (wait, prev_status) for name, wait, prev_status in cursor.fetchall()}
+
+            # Collect all rows first, then load them with ONE server-side COPY.
+            # COPY streams the whole batch in a single protocol message - the
+            # fastest bulk-load path Postgres has, no per-row Parse/Bind at all.
+            rows = []
+            unchanged = 0
+
+            # Bind the lookups once - cheaper than re-resolving the
+            # attributes on every ride
+            resolve_park = park_map.get
+            add_row = rows.append
+
+            for entity in attractions:
+                # One bound-method lookup per ride instead of one per field
+                g = entity.get
+                park_name = resolve_park(g('parkId'), "Unknown")
+                ride_name = g('name')
+                status = g('status')
+
+                attraction_type = g('entityType')
+
+                # One lookup per level instead of re-indexing 'queue' three times
+                standby = (g('queue') or {}).get('STANDBY')
+                wait_time = standby.get('waitTime') if standby else None
+
+                # Only insert if it has a ride name
+                if ride_name:
+                    if last_seen.get(ride_name) == (wait_time, status):
+                        unchanged += 1
+                        continue
+                    add_row((run_time, park_name, ride_name, wait_time, status, attraction_type))
+
+            if rows:
+                # Serialize the batch as CSV in memory (csv handles the
+                # quoting); empty cells become NULLs on the server side.
+                buf = io.StringIO()
+                csv.writer(buf).writerows(
+                    (
+                        ts.isoformat(),
+                        park_name,
+                        ride_name,
+                        wait_time if wait_time is not None else '',
+                        status if status is not None else '',
+                        attraction_type if attraction_type is not None else ''
+                    )
+                    for ts, park_name, ride_name, wait_time, status, attraction_type in rows
+                )
+                buf.seek(0)
+                cursor.copy_expert(
+                    """
+                    COPY wait_times (timestamp, park_name, ride_name, wait_time_minutes, status, attraction_type)
+                    FROM STDIN WITH (FORMAT CSV, NULL '')
+                    """,
+                    buf
+                )
+
+        # No commit here - main()'s 'with conn:' block commits both savers
+        # in ONE transaction.
+        print(f"Successfully saved data for {len(rows)} rides in one batch. Skipped {unchanged} rides with unchanged wait/status. (Using script-generated timestamp)")
     
     except Exception as e:
         print(f"Error during database operation: {e}", file=sys.stderr)
@@ -281,14 +392,20 @@ def main():
     # --- NEW: Capture the current time in UTC ---
     script_run_time = datetime.now(timezone.utc)
     
-    # --- Call both endpoints ---
-    api_data = fetch_wait_times()
-    schedule_data = fetch_schedule_data()
+    # --- Call both endpoints AT THE SAME TIME ---
+    # They are independent GETs, so total fetch time is the slower of the
+    # two instead of the sum. The shared SESSION handles both.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        api_future = pool.submit(fetch_wait_times)
+        schedule_future = pool.submit(fetch_schedule_data)
+        api_data = api_future.result()
+        schedule_data = schedule_future.result()
     
     if api_data:
-        
-        park_statuses = get_main_park_data(api_data)
-        
+
+        # ONE pass over liveData gives us everything downstream needs
+        park_map, park_statuses, attractions, _ = classify_entities(api_data)
+
         if park_statuses:
             all_closed = all(status == 'CLOSED' for status in park_statuses.values())
             found_all_parks = len(park_statuses) == 4
@@ -304,14 +421,16 @@ def main():
             print("Could not determine park statuses from liveData. Proceeding to save data.")
 
         try:
+            # 'with conn:' commits once when the block exits cleanly, so both
+            # savers below share a single transaction and a single commit.
             with psycopg2.connect(DB_URL) as conn:
                 print("Database connection successful.")
-                
+
                 # Pass schedule_data to the daily data saver
                 save_daily_park_data(schedule_data, conn)
                 
                 # --- MODIFIED: Pass the script_run_time to the wait time saver ---
-                save_to_database(api_data, conn, script_run_time)
+                save_to_database(attractions, park_map, conn, script_run_time)
                 
         except psycopg2.OperationalError as e:
             print(f"Error connecting to database: {e}", file=sys.stderr)